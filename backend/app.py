@@ -1,22 +1,39 @@
 # backend/app.py
 import os # os (Operating System) is a built-in Python module that lets your Python code interact with the computer's file system, folders, environment variables, and operating system features.
-import json # json is a Python module used to convert Python data into JSON and JSON into Python data.
+import asyncio # asyncio lets us run several OpenAI requests concurrently without blocking the server
 import uuid # uuid is a built-in Python module used to generate universally unique identifiers
 import logging # logging is a built-in Python module that provides a standard way to record:errors,warnings,debug information,important events
+import time
 
+from contextlib import asynccontextmanager
+from functools import lru_cache # lru_cache remembers recent function results (used for repeated questions)
 from io import BytesIO
 from threading import Lock # Lock is a thread synchronization tool in Python.It ensures that only one thread at a time can execute a piece of code.
-from typing import List, Any, Dict
+from typing import List, Any, Dict, Iterator, Optional, Tuple
 
+import orjson # orjson is a fast C/Rust JSON library (much quicker than the built-in json module)
+import numpy as np # numpy gives us fast vectorised math (BLAS) for embedding similarity
 from fastapi import FastAPI, UploadFile, File, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from dotenv import load_dotenv
 
 # third-party libs used for extraction / embeddings
-import openai
-from pdfminer.high_level import extract_text as pdf_extract_text
+from openai import OpenAI, AsyncOpenAI
+import pymupdf  # PyMuPDF: fast C-based PDF text extraction
+from pdfminer.high_level import extract_text as pdf_extract_text  # fallback for PDFs PyMuPDF can't read
 import docx  # python-docx
+import tiktoken  # OpenAI tokenizer, used to keep embedding requests under the per-request token limit
+
+try:
+    import faiss  # faiss-cpu: approximate nearest-neighbour (HNSW) index for large corpora
+except ImportError:  # optional; without it queries use the exact NumPy scan
+    faiss = None
+
+try:
+    from numba import njit, prange  # JIT-compiled similarity kernel for SIMILARITY_KERNEL=numba
+except ImportError:  # optional
+    njit = None
 
 # Load environment
 load_dotenv()
@@ -25,17 +42,19 @@ if not OPENAI_API_KEY:
     # Don't crash at import time; we will raise on use, but log warning
     print("WARNING: OPENAI_API_KEY not set. Set it in backend/.env")
 
-openai.api_key = OPENAI_API_KEY
-
 # Config
 DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
 #__file__ = full path of the current Python file (app.py)
 # os.path.dirname(__file__) = This gives the folder location of app.py
 #DATA_DIR = "C:\AI Repository\RAG-QA\backend\data"
 
-DATA_FILE = os.path.join(DATA_DIR, "vectors.json")
+META_FILE = os.path.join(DATA_DIR, "vectors.meta.ndjson") # one JSON line per chunk (id, filename, chunk_index, text, preview, row_index, embedding_model, dim)
+EMB_FILE = os.path.join(DATA_DIR, "vectors.f32") # raw float32 embedding rows, appended in row_index order
+LEGACY_DATA_FILE = os.path.join(DATA_DIR, "vectors.json") # old single-file format, migrated on startup
+INDEX_FILE = os.path.join(DATA_DIR, "vectors.hnsw.faiss") # persisted FAISS HNSW index (int8-quantized copy of the embedding rows)
+INDEX_META_FILE = os.path.join(DATA_DIR, "vectors.hnsw.json") # fingerprint of the rows INDEX_FILE was built from (see _index_fingerprint)
 
-#C:\AI Repository\RAG-QA\backend\data\vectors.json
+#C:\AI Repository\RAG-QA\backend\data\vectors.meta.ndjson
 
 ERROR_LOG = os.path.join(os.path.dirname(__file__), "error.log")
 
@@ -43,11 +62,46 @@ ERROR_LOG = os.path.join(os.path.dirname(__file__), "error.log")
 
 CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "800")) #This is the maximum number of characters in each text chunk
 CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "150"))#Chunks overlap by 150 characters.
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "openai").lower() #"openai" (API) or "local" (in-process model, no network hop)
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+LOCAL_EMBEDDING_MODEL = os.getenv("LOCAL_EMBEDDING_MODEL", "BAAI/bge-small-en-v1.5") #SentenceTransformers model used when EMBEDDING_BACKEND=local
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "96")) #Number of chunks sent in one embeddings request.
+EMBEDDING_BATCH_TOKENS = int(os.getenv("EMBEDDING_BATCH_TOKENS", "200000")) #Max total tokens sent in one embeddings request.
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "5")) #Max embeddings requests in flight at once.
 TOP_K = int(os.getenv("TOP_K", "1")) #Number of top similar chunks to retrieve during a query.
-
-# Thread-safety for writes
-_write_lock = Lock()
+PREVIEW_CHARS = 400 #Length of the chunk preview returned in query sources (stored at ingest).
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "10000")) #How many distinct question embeddings to keep in memory.
+ANN_MIN_VECTORS = int(os.getenv("ANN_MIN_VECTORS", "10000")) #Below this many chunks an exact scan is fast enough; above it use the HNSW index.
+HNSW_M = int(os.getenv("HNSW_M", "32")) #Graph neighbours per node in the HNSW index.
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "128")) #Search breadth; higher = better recall, slower queries.
+SIMILARITY_KERNEL = os.getenv("SIMILARITY_KERNEL", "numpy").lower() #Exact scan: "numpy" (BLAS) or "numba" (for hosts without a fast BLAS).
+SQ_TRAIN_SAMPLE = int(os.getenv("SQ_TRAIN_SAMPLE", "100000")) #Rows used to learn the int8 value ranges of the index.
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "4")) #Files of one upload that are extracted/embedded at the same time.
+WRITE_DEBOUNCE_MS = int(os.getenv("WRITE_DEBOUNCE_MS", "50")) #Uploads finishing within this window are written to disk together.
+INDEX_SAVE_SECONDS = int(os.getenv("INDEX_SAVE_SECONDS", "300")) #The in-memory ANN index is written to disk at most this often (and on shutdown).
+if SIMILARITY_KERNEL == "numba" and njit is None:
+    print("WARNING: SIMILARITY_KERNEL=numba but numba is not installed; using the NumPy scan")
+
+# All appends go through one background writer task (see _vector_writer), so no write lock is needed.
+# Created in lifespan(), because an asyncio.Queue belongs to the running event loop.
+_write_queue: Any = None
+_writer_task: Any = None
+# Caps embeddings requests in flight across all uploads (and all files of an upload) at EMBEDDING_CONCURRENCY.
+_embedding_semaphore: Any = None
+
+# Decoded snapshot of the vector store, reused until META_FILE changes on disk (or a write invalidates it)
+# (entry is a single (key, data) tuple so worker threads never see a key paired with the wrong data)
+_store_cache: Dict[str, Any] = {"entry": None}
+
+# Query-side view of that snapshot (matrix, items, model names, ANN index); rebuilt when the snapshot changes.
+# get_embedding_matrix runs in worker threads (it may build the ANN index), so rebuilds are serialized.
+_matrix_cache: Dict[str, Any] = {"E": None, "items": None, "models": None, "index": None}
+_matrix_lock = Lock()
+# The ANN index is extended in place, while queries on the previous snapshot may still search it:
+# faiss doesn't allow add() concurrently with search(), so both take this lock.
+_index_lock = Lock()
+# Fingerprint of what INDEX_FILE holds, so unchanged indexes are not rewritten.
+_index_saved: Dict[str, Any] = {"fingerprint": None}
 
 # Logging
 logger = logging.getLogger("rag_backend")
@@ -58,8 +112,40 @@ formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # start the single writer on startup; on shutdown let it flush what is queued, then stop
+    global _write_queue, _writer_task, _embedding_semaphore
+    _write_queue = asyncio.Queue()
+    _embedding_semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+    if SIMILARITY_KERNEL == "numba" and _numba_scores is not None:
+        # JIT-compile the kernel now (takes seconds) instead of on the first query; on the loop
+        # thread on purpose, like the scans themselves (numba's TBB layer can hang when its
+        # kernels are launched from worker threads) - no requests are served yet anyway
+        _warm_up_numba()
+    _writer_task = asyncio.create_task(_vector_writer())
+    try:
+        yield
+    finally:
+        await _write_queue.put(None)
+        try:
+            await _writer_task
+        finally:
+            _writer_task = None
+            # the index is only saved every INDEX_SAVE_SECONDS: write out the rows added since
+            await asyncio.to_thread(save_ann_index)
+
+
+class ORJSONResponse(JSONResponse):
+    """JSON response rendered with orjson (faster than the stdlib json encoder, handles numpy types)."""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
 # FastAPI app
-app = FastAPI(title="Simple Local RAG Backend")#This sets the title of your API documentation.http://localhost:8000/docs
+app = FastAPI(title="Simple Local RAG Backend", lifespan=lifespan, default_response_class=ORJSONResponse)#This sets the title of your API documentation.http://localhost:8000/docs
 #FastAPI is a Python framework used to create:
 #REST APIs
 #Backend servers
@@ -77,93 +163,272 @@ app.add_middleware(
 
 
 # ----------------- Utilities: data file safe handling -----------------
+def _migrate_legacy_json() -> None:
+    """Convert an old vectors.json (embeddings inline) into META_FILE + EMB_FILE."""
+    with open(LEGACY_DATA_FILE, "rb") as f:
+        legacy = orjson.loads(f.read())
+    items = [it for it in legacy if isinstance(it, dict) and it.get("embedding")] if isinstance(legacy, list) else []
+    # older files stored raw (unnormalized) vectors -> renormalize them to unit length
+    E = normalize_embeddings([it["embedding"] for it in items]) if items else _empty_matrix()
+    meta = []
+    for row, it in enumerate(items):
+        meta.append({
+            "id": it.get("id") or str(uuid.uuid4()),
+            "filename": it.get("filename"),
+            "chunk_index": it.get("chunk_index"),
+            "text": it.get("text", ""),
+            "preview": (it.get("text") or "")[:PREVIEW_CHARS],
+            "row_index": row,
+            "dim": int(E.shape[1]),
+        })
+    save_local_vectors(meta, E)
+    # keep the original around, but out of the way so it isn't migrated again
+    os.replace(LEGACY_DATA_FILE, LEGACY_DATA_FILE + ".bak")
+
+
 def ensure_data_file() -> None:
-    """Ensure data directory and JSON file exist and contain a valid JSON list."""
+    """Ensure data directory and metadata file exist (migrating an old vectors.json)."""
+    if not os.path.exists(DATA_DIR):#If the folder backend/data/ does not exist → create it
+        #exist_ok=True prevents errors if folder already exists
+        os.makedirs(DATA_DIR, exist_ok=True)
+    if os.path.exists(META_FILE):
+        return
     try:
-        if not os.path.exists(DATA_DIR):#If the folder backend/data/ does not exist → create it
-            #exist_ok=True prevents errors if folder already exists
-            os.makedirs(DATA_DIR, exist_ok=True)
-        # If file doesn't exist -> create empty list
-        if not os.path.exists(DATA_FILE):
-            with open(DATA_FILE, "w", encoding="utf-8") as f:
-                json.dump([], f)
+        if os.path.exists(LEGACY_DATA_FILE):
+            _migrate_legacy_json()
             return
+    except Exception as e:
+        logger.error(f"Migrating {LEGACY_DATA_FILE} failed: {e}")
+    # create empty store
+    open(META_FILE, "ab").close()
 
-        # If file exists but is empty or invalid -> backup & rewrite
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            content = f.read()
-            if not content.strip():
-                raise ValueError("empty file")
-            parsed = json.loads(content)
-            if not isinstance(parsed, list):
-                raise ValueError("file not list")
-    except Exception:
-        try:
-            # attempt to backup original file
-            bak = DATA_FILE + ".bak"
-            if os.path.exists(DATA_FILE):
-                with open(DATA_FILE, "r", encoding="utf-8") as orig, open(bak, "w", encoding="utf-8") as ob:
-                    ob.write(orig.read())
-        except Exception:
-            pass
-        # create fresh empty list
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump([], f)
 
+def _empty_matrix() -> np.ndarray:
+    return np.empty((0, 0), dtype=np.float32)
 
-def load_local_vectors() -> List[Dict[str, Any]]:
+
+def iter_local_metadata() -> Iterator[Dict[str, Any]]:
+    """Yield chunk metadata line by line; a torn last line (crash mid-append) is skipped."""
+    with open(META_FILE, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                yield orjson.loads(line)
+            except orjson.JSONDecodeError:
+                logger.error(f"Skipping corrupt line in {META_FILE}")
+
+
+def load_local_vectors(strict: bool = False) -> Tuple[List[Dict[str, Any]], np.ndarray]:
+    """Return (metadata list, embedding matrix). The matrix is memory-mapped read-only.
+
+    The decoded result is cached and shared between callers; it is only re-read when
+    META_FILE's mtime/size change. Treat it as read-only.
+    With strict=True a read error is raised instead of returning an empty store, so
+    writers never mistake "couldn't read" for "no vectors yet".
+    """
     ensure_data_file()
+    st = os.stat(META_FILE)
+    key = (st.st_mtime_ns, st.st_size)
+    entry = _store_cache["entry"]
+    if entry is not None and entry[0] == key:
+        return entry[1]
     try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            if not isinstance(data, list):
-                return []
-            return data
-    except json.JSONDecodeError:
-        # attempt to recover
-        with _write_lock:
-            with open(DATA_FILE, "w", encoding="utf-8") as f:
-                json.dump([], f)
-        return []
+        data = _read_local_vectors()
     except Exception as e:
+        # not cached: the next call retries
         logger.error(f"load_local_vectors error: {e}")
-        return []
-
+        if strict:
+            raise
+        return [], _empty_matrix()
+    _store_cache["entry"] = (key, data)
+    return data
+
+
+def _read_local_vectors() -> Tuple[List[Dict[str, Any]], np.ndarray]:
+    meta = list(iter_local_metadata())
+    if not meta:
+        return [], _empty_matrix()
+    # zero-copy: rows are paged in from disk on demand, no float parsing
+    dim = int(meta[0]["dim"])
+    flat = np.memmap(EMB_FILE, dtype=np.float32, mode="r")
+    E = flat[: flat.size // dim * dim].reshape(-1, dim)
+    rows = [it["row_index"] for it in meta]
+    if rows[-1] >= E.shape[0]:
+        raise ValueError(f"{EMB_FILE} has {E.shape[0]} rows, metadata needs {rows[-1] + 1}")
+    if rows[-1] != len(meta) - 1:
+        # some metadata lines were lost -> gather only the rows still referenced (copies)
+        return meta, E[rows]
+    return meta, E[: len(meta)]
+
+
+def _fsync_write(f: Any, data: bytes) -> None:
+    f.write(data)
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def _dump_ndjson(items: List[Dict[str, Any]]) -> bytes:
+    opts = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_APPEND_NEWLINE
+    return b"".join(orjson.dumps(it, option=opts) for it in items)
+
+
+def append_local_vectors(meta: List[Dict[str, Any]], new_meta: List[Dict[str, Any]], E_new: np.ndarray) -> None:
+    """Append new chunks to the store: one write + fsync per file, instead of rewriting everything.
+
+    `meta` is the current metadata (from load_local_vectors(strict=True)); new_meta rows
+    must continue its row_index sequence.
+    """
+    E_new = np.ascontiguousarray(E_new, dtype=np.float32)
+    row_bytes = E_new.shape[1] * E_new.itemsize
+    # embeddings first: metadata must never point at rows that are not on disk yet
+    with open(EMB_FILE, "ab") as f:
+        size = f.tell()
+        expected = (meta[-1]["row_index"] + 1) * row_bytes if meta else 0
+        if not meta and size and os.path.getsize(META_FILE):
+            if _has_complete_line(META_FILE):
+                # metadata exists on disk but none of it could be used -> don't touch the rows it points at
+                raise RuntimeError(f"{META_FILE} has no readable chunks but {EMB_FILE} is not empty; refusing to append")
+            # only a torn first line (the very first upload crashed mid-append): nothing was stored yet
+            os.truncate(META_FILE, 0)
+        if size < expected:
+            raise RuntimeError(f"{EMB_FILE} is missing rows that {META_FILE} refers to; refusing to append")
+        if size > expected:
+            # drop rows left behind by an interrupted upload (never rows the metadata refers to)
+            f.truncate(expected)
+        _fsync_write(f, E_new.tobytes())
+
+    with open(META_FILE, "ab") as f:
+        lines = _dump_ndjson(new_meta)
+        if f.tell() and not _ends_with_newline(META_FILE):
+            lines = b"\n" + lines  # don't glue onto a torn last line
+        _fsync_write(f, lines)
+    # don't rely on mtime alone (coarse on some filesystems): force the next load to re-read
+    _store_cache["entry"] = None
+
+
+def _has_complete_line(path: str) -> bool:
+    """True if path holds at least one newline-terminated, non-blank line (i.e. not just a torn tail)."""
+    with open(path, "rb") as f:
+        return any(line.endswith(b"\n") and line.strip() for line in f)
+
+
+def _ends_with_newline(path: str) -> bool:
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def save_local_vectors(meta: List[Dict[str, Any]], E: np.ndarray) -> None:
+    """Rewrite (compact) the whole store atomically using tmp files and replace."""
+    tmp = EMB_FILE + ".tmp"
+    with open(tmp, "wb") as f:
+        _fsync_write(f, np.ascontiguousarray(E, dtype=np.float32).tobytes())
+    os.replace(tmp, EMB_FILE)
+
+    tmp = META_FILE + ".tmp"
+    with open(tmp, "wb") as f:
+        _fsync_write(f, _dump_ndjson(meta))
+    os.replace(tmp, META_FILE)
+    _store_cache["entry"] = None
+
+
+async def write_vectors(new_meta: List[Dict[str, Any]], E_new: np.ndarray) -> None:
+    """Queue new chunks for the background writer and wait until they are on disk.
+
+    Raises RuntimeError if the writer is not running, instead of waiting forever on a queue nobody reads.
+    """
+    writer = _writer_task
+    if writer is None or writer.done():
+        raise RuntimeError("Vector writer is not running")
+    done = asyncio.get_running_loop().create_future()
+    await _write_queue.put((new_meta, E_new, done))
+    # also wake up if the writer dies before it gets to this job
+    await asyncio.wait({done, writer}, return_when=asyncio.FIRST_COMPLETED)
+    if not done.done():
+        raise RuntimeError("Vector writer stopped before the vectors were written")
+    await done
+
+
+async def _vector_writer() -> None:
+    """Single consumer of _write_queue: uploads arriving close together share one append + fsync.
+
+    Row indexes are assigned here, so concurrent uploads can never claim the same rows.
+    """
+    stopping = False
+    last_index_save = time.monotonic()
+    while not stopping:
+        batch = [await _write_queue.get()]
+        await asyncio.sleep(WRITE_DEBOUNCE_MS / 1000)  # let other uploads join this write
+        while not _write_queue.empty():
+            batch.append(_write_queue.get_nowait())
+        if any(job is None for job in batch):  # shutdown sentinel: write what we have, then exit
+            stopping = True
+            batch = [job for job in batch if job is not None]
+        if not batch:
+            continue
 
-def save_local_vectors(data: List[Dict[str, Any]]) -> None:
-    # atomic write using tmp file and replace
-    with _write_lock:
-        tmp = DATA_FILE + ".tmp"
-        with open(tmp, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        os.replace(tmp, DATA_FILE)
+        try:
+            # strict: if the store can't be read, refuse the write rather than treat it as empty
+            meta, _ = await asyncio.to_thread(load_local_vectors, True)
+            next_row = meta[-1]["row_index"] + 1 if meta else 0
+            new_meta = [it for items, _, _ in batch for it in items]
+            for row, it in enumerate(new_meta, start=next_row):
+                it["row_index"] = row
+            E_new = np.vstack([E for _, E, _ in batch])
+            # blocking file I/O + fsync off the event loop
+            await asyncio.to_thread(append_local_vectors, meta, new_meta, E_new)
+            # refresh the matrix cache now so the ANN index is extended at ingest, not on the next query
+            await asyncio.to_thread(get_embedding_matrix)
+        except Exception as e:
+            logger.exception("Writing vectors failed")
+            for _, _, done in batch:
+                if not done.done():  # the upload may have been cancelled meanwhile
+                    done.set_exception(e)
+            continue
+        for _, _, done in batch:
+            if not done.done():
+                done.set_result(None)
+        if time.monotonic() - last_index_save >= INDEX_SAVE_SECONDS:
+            # after answering the uploads, so they never wait for the (large) index file
+            await asyncio.to_thread(save_ann_index)
+            last_index_save = time.monotonic()
 
 
 # ----------------- Text extraction -----------------
-def extract_text_from_upload(upload: UploadFile) -> str:
+async def extract_text_from_upload(upload: UploadFile) -> str:
     """Support .txt, .pdf, .docx. Raise HTTPException on unsupported types."""
-    name = (upload.filename or "").lower()
-    raw = upload.file.read()
-    upload.file.seek(0)
+    # async read keeps the event loop free; parsing runs in a worker thread
+    raw = await upload.read()
+    return await asyncio.to_thread(_extract_text_sync, upload.filename or "", raw)
+
+
+def _extract_text_sync(filename: str, raw: bytes) -> str:
+    name = filename.lower()
     if name.endswith(".txt"):
         try:
             return raw.decode("utf-8", errors="ignore")
         except Exception:
             return raw.decode("latin-1", errors="ignore")
     if name.endswith(".pdf"):
+        try:
+            with pymupdf.open(stream=raw, filetype="pdf") as doc:
+                return "\n".join(page.get_text() for page in doc)
+        except Exception as e:
+            logger.error(f"PyMuPDF extract error for {filename}, falling back to pdfminer: {e}")
         try:
             return pdf_extract_text(BytesIO(raw))
         except Exception as e:
-            logger.error(f"PDF extract error for {upload.filename}: {e}")
-            raise HTTPException(status_code=400, detail=f"PDF extract failed: {upload.filename}")
+            logger.error(f"PDF extract error for {filename}: {e}")
+            raise HTTPException(status_code=400, detail=f"PDF extract failed: {filename}")
     if name.endswith(".docx"):
         try:
             doc = docx.Document(BytesIO(raw))
             return "\n".join([p.text for p in doc.paragraphs])
         except Exception as e:
-            logger.error(f"DOCX extract error for {upload.filename}: {e}")
-            raise HTTPException(status_code=400, detail=f"DOCX extract failed: {upload.filename}")
-    raise HTTPException(status_code=400, detail=f"Unsupported file type: {upload.filename}")
+            logger.error(f"DOCX extract error for {filename}: {e}")
+            raise HTTPException(status_code=400, detail=f"DOCX extract failed: {filename}")
+    raise HTTPException(status_code=400, detail=f"Unsupported file type: {filename}")
 
 
 # ----------------- Chunking -----------------
@@ -173,44 +438,339 @@ def chunk_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVE
     text = text.strip()
     if not text:
         return []
-    chunks: List[str] = []
-    start = 0
-    n = len(text)
-    while start < n:
-        end = start + chunk_size
-        chunk = text[start:end]
-        chunks.append(chunk.strip())
-        start = end - overlap
-    return [c for c in chunks if c]
+    # one pass over precomputed window starts; empty (whitespace-only) windows are dropped
+    step = chunk_size - overlap
+    windows = (text[start:start + chunk_size].strip() for start in range(0, len(text), step))
+    return [c for c in windows if c]
 
 
 # ----------------- Embeddings -----------------
-def get_embeddings(texts: List[str]) -> List[List[float]]:
-    """Call OpenAI Embeddings API. Raises exception if API key missing."""
-    if not openai.api_key:
+_clients: Dict[str, Any] = {}
+
+
+def _openai_client(kind: str = "sync") -> Any:
+    """Create OpenAI clients lazily, so a missing key only fails when embeddings are requested."""
+    if not OPENAI_API_KEY:
         raise RuntimeError("OPENAI_API_KEY not configured. Set it in backend/.env")
-    # OpenAI supports batching by passing list of inputs
-    resp = openai.Embedding.create(input=texts, model=EMBEDDING_MODEL)
-    embeddings = [d["embedding"] for d in resp["data"]]
+    if kind not in _clients:
+        _clients[kind] = AsyncOpenAI(api_key=OPENAI_API_KEY) if kind == "async" else OpenAI(api_key=OPENAI_API_KEY)
+    return _clients[kind]
+
+
+def embedding_model_id() -> str:
+    """Name of the active embedding model, stored with each chunk to detect incompatible vectors."""
+    if EMBEDDING_BACKEND == "local":
+        return f"local:{LOCAL_EMBEDDING_MODEL}"
+    return f"openai:{EMBEDDING_MODEL}"
+
+
+def _local_model() -> Any:
+    """Load the local SentenceTransformers model once, on first use."""
+    if "local" not in _clients:
+        # optional dependency, only needed for EMBEDDING_BACKEND=local
+        from sentence_transformers import SentenceTransformer
+        _clients["local"] = SentenceTransformer(LOCAL_EMBEDDING_MODEL)
+    return _clients["local"]
+
+
+@lru_cache(maxsize=1)
+def _token_encoder() -> Any:
+    """tiktoken encoding for EMBEDDING_MODEL, or None if it can't be loaded (e.g. offline)."""
+    try:
+        try:
+            return tiktoken.encoding_for_model(EMBEDDING_MODEL)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.error(f"tiktoken unavailable, estimating tokens from length: {e}")
+        return None
+
+
+def _embedding_batches(texts: List[str]) -> List[List[str]]:
+    """Greedily split texts into request-sized batches.
+
+    A batch is flushed when it reaches EMBEDDING_BATCH_SIZE inputs or EMBEDDING_BATCH_TOKENS tokens,
+    so large documents never exceed the API's per-request limits.
+    """
+    if len(texts) <= 1:
+        return [texts] if texts else []  # nothing to split (e.g. a query): don't load the tokenizer
+    enc = _token_encoder()
+    if enc is not None:
+        counts = [len(tokens) for tokens in enc.encode_ordinary_batch(texts)]
+    else:
+        counts = [len(t) // 3 + 1 for t in texts]  # rough upper bound for English text
+    batches: List[List[str]] = []
+    batch: List[str] = []
+    batch_tokens = 0
+    for text, n_tokens in zip(texts, counts):
+        if batch and (len(batch) >= EMBEDDING_BATCH_SIZE or batch_tokens + n_tokens > EMBEDDING_BATCH_TOKENS):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(text)
+        batch_tokens += n_tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def get_embeddings(texts: List[str]) -> Any:
+    """Embed texts with the configured backend. Raises exception if API key missing (openai backend)."""
+    if EMBEDDING_BACKEND == "local":
+        return _local_model().encode(texts, batch_size=64, normalize_embeddings=True, convert_to_numpy=True)
+    # OpenAI supports batching by passing list of inputs; split so each request stays within limits
+    client = _openai_client()
+    embeddings = []
+    for batch in _embedding_batches(texts):
+        resp = client.embeddings.create(input=batch, model=EMBEDDING_MODEL)
+        embeddings.extend(d.embedding for d in resp.data)
     return embeddings
 
 
+async def gather_or_cancel(coros: List[Any]) -> List[Any]:
+    """Like asyncio.gather, but on the first error cancel the remaining tasks before re-raising it.
+
+    Plain gather leaves them running, e.g. still sending embedding requests for a failed upload.
+    """
+    tasks = [asyncio.create_task(c) for c in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def aget_embeddings(texts: List[str]) -> Any:
+    """Async version of get_embeddings: sends sub-batches concurrently, keeps input order."""
+    if EMBEDDING_BACKEND == "local":
+        # CPU-bound model inference -> run it off the event loop
+        return await asyncio.to_thread(get_embeddings, texts)
+    client = _openai_client("async")
+    # shared by every caller, so concurrent files/uploads stay under one limit (a private one outside the app)
+    semaphore = _embedding_semaphore or asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+
+    async def embed_batch(batch: List[str]) -> List[List[float]]:
+        async with semaphore:
+            resp = await client.embeddings.create(input=batch, model=EMBEDDING_MODEL)
+        return [d.embedding for d in resp.data]
+
+    # tokenizing a large document is CPU work -> keep it off the event loop
+    batches = await asyncio.to_thread(_embedding_batches, texts)
+    results = await gather_or_cancel([embed_batch(b) for b in batches])
+    return [emb for batch in results for emb in batch]
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _embed_query(model_id: str, q: str) -> np.ndarray:
+    """Unit-length embedding of a question; repeated questions skip the embedding call.
+
+    model_id is part of the cache key so switching models never returns stale vectors.
+    """
+    emb = normalize_embeddings(get_embeddings([q])[0])
+    emb.flags.writeable = False  # shared between requests, must not be modified
+    return emb
+
+
 # ----------------- Similarity utilities -----------------
-def dot(a: List[float], b: List[float]) -> float:
-    return sum(x * y for x, y in zip(a, b))
+def normalize_embeddings(emb: Any) -> np.ndarray:
+    """L2-normalize a vector (or each row of a matrix) so cosine similarity is a plain dot product."""
+    arr = np.array(emb, dtype=np.float32)
+    norms = np.linalg.norm(arr, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0  # leave all-zero vectors as they are
+    arr /= norms
+    return arr
+
+
+def get_embedding_matrix() -> Dict[str, Any]:
+    """Return the cached (N, D) matrix of unit-length embeddings and the matching items.
+
+    Can block for seconds (re-reading the store, building the ANN index): call it from
+    async code via asyncio.to_thread.
+    """
+    global _matrix_cache
+    with _matrix_lock:
+        meta, E = load_local_vectors()
+        if _matrix_cache["items"] is meta:  # same snapshot as last time
+            return _matrix_cache
+
+        index = None
+        if len(meta) >= ANN_MIN_VECTORS:
+            index = get_ann_index(meta, E, _matrix_cache["items"], _matrix_cache["index"])
+        # a new dict, so callers still holding the previous snapshot never see it half-updated
+        _matrix_cache = {"E": E, "items": meta, "models": {it.get("embedding_model") for it in meta}, "index": index}
+        return _matrix_cache
+
+
+def _index_fingerprint(items: List[Dict[str, Any]], n: int) -> List[Any]:
+    """Identify the first n rows of the store: their count and the ids of the first and last chunk.
+
+    Chunk ids are random, so a store that was reset and re-uploaded never matches an old index.
+    """
+    return [n, items[0].get("id"), items[n - 1].get("id")] if n else [0, None, None]
+
+
+def _read_ann_index(meta: List[Dict[str, Any]], E: np.ndarray) -> Any:
+    """The persisted index if it was built from a prefix of the current rows, else None."""
+    if not (os.path.exists(INDEX_FILE) and os.path.exists(INDEX_META_FILE)):
+        return None
+    with open(INDEX_META_FILE, "rb") as f:
+        fingerprint = orjson.loads(f.read())
+    index = faiss.read_index(INDEX_FILE)
+    if not _index_matches(index, fingerprint, meta, E):
+        return None
+    _index_saved["fingerprint"] = fingerprint
+    return index
+
+
+def _index_matches(index: Any, fingerprint: List[Any], meta: List[Dict[str, Any]], E: np.ndarray) -> bool:
+    """True if index (built from the rows `fingerprint` describes) covers a prefix of the current rows."""
+    n = index.ntotal
+    return (
+        isinstance(index, faiss.IndexHNSWSQ)
+        and index.d == E.shape[1]
+        and n <= len(meta)
+        and fingerprint == _index_fingerprint(meta, n)
+    )
+
+
+def _write_ann_index(index: Any, meta: List[Dict[str, Any]]) -> None:
+    # index first: a crash before the fingerprint is replaced leaves a mismatch -> rebuilt on next load
+    tmp = INDEX_FILE + ".tmp"
+    faiss.write_index(index, tmp)
+    os.replace(tmp, INDEX_FILE)
+    tmp = INDEX_META_FILE + ".tmp"
+    with open(tmp, "wb") as f:
+        _fsync_write(f, orjson.dumps(_index_fingerprint(meta, index.ntotal)))
+    os.replace(tmp, INDEX_META_FILE)
+
+
+def save_ann_index() -> None:
+    """Write the current in-memory index to disk if it has changed since the last save.
+
+    Blocks for as long as writing the file takes: call it from async code via asyncio.to_thread.
+    """
+    with _matrix_lock:  # no rows are added while the file is written
+        index, items = _matrix_cache["index"], _matrix_cache["items"]
+        if index is None:
+            return
+        fingerprint = _index_fingerprint(items, index.ntotal)
+        if fingerprint == _index_saved["fingerprint"]:
+            return
+        try:
+            _write_ann_index(index, items)
+            _index_saved["fingerprint"] = fingerprint
+        except Exception as e:
+            logger.error(f"Saving ANN index failed: {e}")
 
 
-def norm(a: List[float]) -> float:
-    import math
-    return math.sqrt(sum(x * x for x in a))
+def get_ann_index(
+    meta: List[Dict[str, Any]], E: np.ndarray, prev_items: Optional[List[Dict[str, Any]]] = None, prev_index: Any = None
+) -> Any:
+    """Return an HNSW index over all rows of E.
 
+    The previous snapshot's index (prev_index over prev_items) is extended in memory with just the
+    new rows; the persisted index is only read when there is none yet (i.e. at startup), and is
+    written back by save_ann_index, not here.
 
-def cosine_similarity(a: List[float], b: List[float]) -> float:
-    na = norm(a)
-    nb = norm(b)
-    if na == 0 or nb == 0:
-        return 0.0
-    return dot(a, b) / (na * nb)
+    Vectors are unit length, so inner product == cosine similarity. The index keeps its copy of
+    the vectors as 8-bit scalar-quantized codes (1 byte per value instead of 4); the float32 rows on
+    disk stay the source of truth. Returns None when faiss is not installed or the index can't be
+    built (queries then fall back to the exact scan).
+    """
+    if faiss is None:
+        return None
+    try:
+        # the index must cover a prefix of the current rows (the store only grows by appending)
+        if prev_index is not None:
+            fingerprint = _index_fingerprint(prev_items, prev_index.ntotal)
+            index = prev_index if _index_matches(prev_index, fingerprint, meta, E) else None
+        else:
+            index = _read_ann_index(meta, E)
+        if index is None:
+            index = faiss.IndexHNSWSQ(E.shape[1], faiss.ScalarQuantizer.QT_8bit, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            # learn per-dimension value ranges for the int8 codes; later appends reuse them
+            step = max(1, E.shape[0] // SQ_TRAIN_SAMPLE)
+            index.train(np.ascontiguousarray(E[::step], dtype=np.float32))
+        if index.ntotal < E.shape[0]:
+            new_rows = np.ascontiguousarray(E[index.ntotal:], dtype=np.float32)
+            with _index_lock:
+                index.add(new_rows)
+        return index
+    except Exception as e:
+        logger.error(f"ANN index error: {e}")
+        return None
+
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _numba_scores(E, q):
+        # one fused pass per row, rows split across cores; no intermediate arrays
+        out = np.empty(E.shape[0], dtype=np.float32)
+        for i in prange(E.shape[0]):
+            d = np.float32(0.0)
+            for j in range(E.shape[1]):
+                d += E[i, j] * q[j]
+            out[i] = d
+        return out
+else:
+    _numba_scores = None
+
+
+def _warm_up_numba() -> None:
+    # read-only inputs, like the memory-mapped matrix and the cached query vector (numba compiles per type)
+    E = np.zeros((1, 1), dtype=np.float32)
+    E.flags.writeable = False
+    _numba_scores(E, E[0])
+
+
+def search_vectors(cache: Dict[str, Any], q: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Return (scores, row positions) of the k best matches for unit-length query q, best first."""
+    index = cache["index"]
+    if index is not None:
+        # k past the row count only pads the result with -1; a huge k would also balloon efSearch
+        n = len(cache["items"])
+        k = min(k, n)
+        params = faiss.SearchParametersHNSW(efSearch=max(HNSW_EF_SEARCH, k))
+        with _index_lock:
+            D, I = index.search(q[None, :], k, params=params)
+        # the index may already hold rows appended after this snapshot: drop those (and -1 padding)
+        found = (I[0] >= 0) & (I[0] < n)
+        return D[0][found], I[0][found]
+
+    # exact scan: stored vectors are unit length, so cosine similarity is just E @ q
+    if SIMILARITY_KERNEL == "numba" and _numba_scores is not None:
+        scores = _numba_scores(np.asarray(cache["E"]), q)
+    else:
+        scores = cache["E"] @ q
+    top_idx = top_k_indices(scores, k)
+    return scores[top_idx], top_idx
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Positions of the k highest scores, best first, in O(N) instead of sorting all N scores."""
+    n = len(scores)
+    k = min(k, n)
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    if k == 1:  # the default TOP_K: a single max scan
+        return np.array([np.argmax(scores)])
+    # partition around position n-k (avoids allocating -scores), then sort just the k winners
+    top_idx = np.argpartition(scores, n - k)[n - k:] if k < n else np.arange(n)
+    return top_idx[np.argsort(scores[top_idx])[::-1]]
+
+
+def check_embedding_compatibility(models: set, stored_dim: int, dim: int = 0) -> None:
+    """Raise 409 if stored vectors came from a different embedding model or dimension."""
+    current = embedding_model_id()
+    other = models - {None, current}  # chunks stored before model tracking have no name
+    if other or (dim and stored_dim and stored_dim != dim):
+        found = ", ".join(sorted(other)) if other else f"{stored_dim}-dim vectors"
+        raise HTTPException(
+            status_code=409,
+            detail=f"Stored vectors were built with {found}, but the current model is {current}. "
+                   "Clear the vector store and re-upload your documents.",
+        )
 
 
 # ----------------- Endpoints -----------------
@@ -223,7 +783,32 @@ async def health():
 async def generic_exception_handler(request: Request, exc: Exception):
     # log full traceback for server-side debugging
     logger.exception("Unhandled error")
-    return JSONResponse(status_code=500, content={"detail": str(exc)})
+    return ORJSONResponse(status_code=500, content={"detail": str(exc)})
+
+
+async def _process_upload(upload: UploadFile, semaphore: asyncio.Semaphore, stored_dim: int) -> Optional[Tuple[List[str], np.ndarray]]:
+    """Extract, chunk and embed one uploaded file. Returns None if the file is skipped."""
+    async with semaphore:
+        try:
+            text = await extract_text_from_upload(upload)
+        except HTTPException as he:
+            # skip unsupported/broken file but continue other files
+            logger.error(f"Skipping file {upload.filename}: {he.detail}")
+            return None
+
+        chunks = chunk_text(text)
+        if not chunks:
+            return None
+
+        # get embeddings in batches (OpenAI can handle multiple inputs)
+        try:
+            # normalize once at ingest so queries don't recompute stored norms
+            embeddings = normalize_embeddings(await aget_embeddings(chunks))
+        except Exception as e:
+            logger.exception("Embedding generation failed")
+            raise HTTPException(status_code=500, detail=f"Embedding error: {e}")
+        check_embedding_compatibility(set(), stored_dim, embeddings.shape[1])
+        return chunks, embeddings
 
 
 @app.post("/api/admin/upload")
@@ -240,42 +825,41 @@ async def upload_files(files: List[UploadFile] = File(...)):
         if not files:
             return {"status": "error", "detail": "No files provided."}
 
-        # load current vectors
-        all_vectors = load_local_vectors()
-
-        for upload in files:
-            try:
-                text = extract_text_from_upload(upload)
-            except HTTPException as he:
-                # skip unsupported/broken file but continue other files
-                logger.error(f"Skipping file {upload.filename}: {he.detail}")
-                continue
-
-            chunks = chunk_text(text)
-            if not chunks:
+        # current vectors (cached) - new chunks must use the same embedding model
+        cache = await asyncio.to_thread(get_embedding_matrix)
+        stored_dim = cache["E"].shape[1] if cache["items"] else 0
+        check_embedding_compatibility(cache["models"], stored_dim)
+        model_id = embedding_model_id()
+        new_meta: List[Dict[str, Any]] = []
+        new_embeddings: List[np.ndarray] = []
+
+        # extract + embed files concurrently: one file is parsed while another waits on OpenAI
+        semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+        # one failed file stops the others, so they don't keep calling OpenAI
+        results = await gather_or_cancel([_process_upload(upload, semaphore, stored_dim) for upload in files])
+
+        for upload, result in zip(files, results):
+            if result is None:
                 continue
-
-            # get embeddings in batches (OpenAI can handle multiple inputs)
-            try:
-                embeddings = get_embeddings(chunks)
-            except Exception as e:
-                logger.exception("Embedding generation failed")
-                raise HTTPException(status_code=500, detail=f"Embedding error: {e}")
-
-            # upsert chunk items to local list
-            for idx, (chunk, emb) in enumerate(zip(chunks, embeddings)):
+            chunks, embeddings = result
+            # row_index (position in the embedding matrix) is assigned by the writer
+            for idx, chunk in enumerate(chunks):
                 item = {
                     "id": str(uuid.uuid4()),
                     "filename": upload.filename,
                     "chunk_index": idx,
                     "text": chunk,
-                    "embedding": emb,
+                    "preview": chunk[:PREVIEW_CHARS],
+                    "embedding_model": model_id,
+                    "dim": int(embeddings.shape[1]),
                 }
-                all_vectors.append(item)
+                new_meta.append(item)
                 total_added += 1
+            new_embeddings.append(embeddings)
 
-        # persist to disk
-        save_local_vectors(all_vectors)
+        # persist to disk: only the new rows are appended (batched with concurrent uploads)
+        if new_meta:
+            await write_vectors(new_meta, np.vstack(new_embeddings))
         return {"status": "ok", "added_chunks": total_added}
     except HTTPException:
         raise
@@ -301,31 +885,29 @@ async def query(payload: Dict[str, Any]):
 
         # embed the question
         try:
-            q_emb = get_embeddings([q])[0]
+            # in a thread: a cache miss makes a blocking API call (or loads the local model)
+            q_emb = await asyncio.to_thread(_embed_query, embedding_model_id(), q)
         except Exception as e:
             logger.exception("Failed to embed query")
             raise HTTPException(status_code=500, detail=f"Embedding error: {e}")
 
-        # load vectors
-        data = load_local_vectors()
-        if not data:
+        # load the stacked embedding matrix (cached until the vector store changes);
+        # in a thread because a first load may build the ANN index
+        cache = await asyncio.to_thread(get_embedding_matrix)
+        E, items = cache["E"], cache["items"]
+        if not items:
             return {"answer": "", "sources": []}
-
-        # compute similarity scores
-        scored = []
-        for item in data:
-            emb = item.get("embedding")
-            if not emb:
-                continue
-            try:
-                score = cosine_similarity(q_emb, emb)
-            except Exception:
-                score = 0.0
-            scored.append((score, item))
-
-        # sort and take top k
-        scored.sort(key=lambda x: x[0], reverse=True)
-        top = scored[:k]
+        check_embedding_compatibility(cache["models"], E.shape[1], len(q_emb))
+        k = min(k, len(items))
+
+        # HNSW index for large corpora, exact matrix-vector scan otherwise
+        if cache["index"] is not None:
+            # in a thread: an HNSW search may wait for rows being added to the index
+            scores, top_idx = await asyncio.to_thread(search_vectors, cache, q_emb, k)
+        else:
+            # below ANN_MIN_VECTORS the scan takes milliseconds; keep it (and numba) on the loop thread
+            scores, top_idx = search_vectors(cache, q_emb, k)
+        top = [(float(score), items[i]) for score, i in zip(scores, top_idx)]
 
         # build answer by concatenating top chunks (simple)
         answer = "\n\n---\n".join([it["text"] for _, it in top])
@@ -335,12 +917,14 @@ async def query(payload: Dict[str, Any]):
                 "filename": it.get("filename"),
                 "chunk_index": it.get("chunk_index"),
                 "score": float(score),
-                "text": it.get("text")[:400],
+                # chunks stored before previews existed fall back to slicing the text
+                "text": it["preview"] if "preview" in it else it.get("text", "")[:PREVIEW_CHARS],
             }
             for score, it in top
         ]
 
-        return {"answer": answer, "sources": sources}
+        # returned directly so FastAPI skips its jsonable_encoder pass over the payload
+        return ORJSONResponse({"answer": answer, "sources": sources})
     except HTTPException:
         raise
     except Exception as exc:
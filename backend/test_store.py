@@ -0,0 +1,71 @@
+# backend/test_store.py
+# Recovery checks for the append-only vector store (run with: python -m pytest backend)
+import numpy as np
+import pytest
+
+import app
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """Point the store at an empty temp directory."""
+    monkeypatch.setattr(app, "DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(app, "META_FILE", str(tmp_path / "vectors.meta.ndjson"))
+    monkeypatch.setattr(app, "EMB_FILE", str(tmp_path / "vectors.f32"))
+    monkeypatch.setattr(app, "LEGACY_DATA_FILE", str(tmp_path / "vectors.json"))
+    monkeypatch.setattr(app, "INDEX_FILE", str(tmp_path / "vectors.hnsw.faiss"))
+    monkeypatch.setattr(app, "INDEX_META_FILE", str(tmp_path / "vectors.hnsw.json"))
+    monkeypatch.setitem(app._store_cache, "entry", None)
+    return tmp_path
+
+
+def _chunks(start, n, dim=4):
+    meta = [{"id": f"c{row}", "text": f"chunk {row}", "row_index": row, "dim": dim} for row in range(start, start + n)]
+    E = app.normalize_embeddings(np.random.default_rng(start).standard_normal((n, dim)))
+    return meta, E
+
+
+def test_torn_first_line_is_discarded(store):
+    # first-ever upload crashed after writing its rows but partway through its first metadata line
+    np.zeros((4, 4), dtype=np.float32).tofile(app.EMB_FILE)
+    with open(app.META_FILE, "wb") as f:
+        f.write(b'{"id":"x","filename":"a.t')
+
+    meta, _ = app.load_local_vectors(strict=True)
+    assert meta == []
+    new_meta, E_new = _chunks(0, 2)
+    app.append_local_vectors(meta, new_meta, E_new)
+
+    meta, E = app.load_local_vectors(strict=True)
+    assert [it["id"] for it in meta] == ["c0", "c1"]
+    np.testing.assert_allclose(E, E_new)
+
+
+def test_torn_last_line_is_skipped(store):
+    meta, E1 = _chunks(0, 2)
+    app.append_local_vectors([], meta, E1)
+    # a later upload died mid-append: extra rows on disk, half a metadata line
+    with open(app.EMB_FILE, "ab") as f:
+        f.write(np.ones((3, 4), dtype=np.float32).tobytes())
+    with open(app.META_FILE, "ab") as f:
+        f.write(b'{"id":"c2","te')
+
+    meta, _ = app.load_local_vectors(strict=True)
+    new_meta, E2 = _chunks(2, 1)
+    app.append_local_vectors(meta, new_meta, E2)
+
+    meta, E = app.load_local_vectors(strict=True)
+    assert [it["id"] for it in meta] == ["c0", "c1", "c2"]
+    np.testing.assert_allclose(E, np.vstack([E1, E2]))
+
+
+def test_unreadable_metadata_keeps_rows(store):
+    # complete but unparsable lines: the rows may still be referenced, so nothing is truncated
+    np.zeros((2, 4), dtype=np.float32).tofile(app.EMB_FILE)
+    with open(app.META_FILE, "wb") as f:
+        f.write(b"not json\n")
+
+    new_meta, E_new = _chunks(0, 1)
+    with pytest.raises(RuntimeError):
+        app.append_local_vectors([], new_meta, E_new)
+    assert np.fromfile(app.EMB_FILE, dtype=np.float32).size == 8